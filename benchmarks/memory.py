@@ -0,0 +1,68 @@
+"""Reports the memory used by the scheduled runs for each repo.
+
+Usage: python benchmarks/memory.py [REPO_COUNT...]
+"""
+
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from datetime import datetime
+
+from grony.dotfile import load_dotfile
+from grony.scheduler import Action, SchedulerThread
+
+from tabulate import tabulate
+
+from typing import List, Tuple
+
+
+def write_dotfile(path: str, repo_count: int) -> None:
+    lines = ['[config]', 'ipc_port = 62830', 'secret = bench']
+    for i in range(repo_count):
+        lines += [f"[repo 'repo-{i}']",
+                  f'path = /srv/git/repo-{i}',
+                  'pull-on = */15 * * * *',
+                  'commit-on = 0 * * * *',
+                  'push-on = 5 * * * *',
+                  'maintain-on = @daily']
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def measure(repo_count: int) -> Tuple[int, int, int, int]:
+    """Returns the number of runs and the bytes used by the RepoTable
+    and runs, per repo and per run.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'grony.conf')
+        write_dotfile(path, repo_count)
+        dotfile = load_dotfile(path)
+        scheduler = SchedulerThread(path, 5)
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            runs = scheduler._schedule_next(dotfile, datetime.now())
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+    total = sum(stat.size_diff
+                for stat in after.compare_to(before, 'filename'))
+    return (len(runs), total, total // repo_count, total // len(runs))
+
+
+def main(args: List[str]) -> None:
+    counts = [int(arg) for arg in args] or [100, 1000]
+    rows = [(count,) + measure(count) for count in counts]
+    print(tabulate(rows, headers=('Repos', 'Runs', 'Bytes',
+                                  'Bytes/repo', 'Bytes/run'),
+                   tablefmt='simple'))
+    print(f'{len(Action)} actions per repo.')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,4 +1,5 @@
 import os
+import json
 import click
 import signal
 import logging
@@ -8,19 +9,22 @@ from urllib.error import URLError
 
 from grony.client import Client
 from grony.server import ServerThread
-from grony.dotfile import load_dotfile
-from grony.scheduler import SchedulerThread
+from grony.dotfile import Dotfile, load_dotfile
+from grony.scheduler import Action, SchedulerThread
+from grony import profiling
 from grony.cli_output import info, success, err, warn, fatal
 
 from tabulate import tabulate
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 DEFAULT_CONF = os.environ.get('GRONY_CONFIG_PATH', None)
 if not DEFAULT_CONF:
     dir = Path.joinpath(os.environ.get('XDG_CONFIG_HOME', Path.home()), '.grony')
     DEFAULT_CONF = Path.joinpath(dir, 'grony.conf')
 
+ACTION_NAMES = tuple(action.value for action in Action)
+
 
 def _is_success(result: Dict[str, Any]) -> bool:
     messages: Optional[List[Dict[str, str]]] = result.get('messages', None)
@@ -53,6 +57,45 @@ def _display_result(result: Dict[str, Any]) -> None:
         fn(message)
 
 
+def _escape_tsv(value: Any) -> str:
+    return str(value if value is not None else '') \
+        .replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def _print_rows(rows: Iterable[Tuple[Any, ...]], headers: Tuple[str, ...],
+                output_format: str) -> None:
+    """Prints rows in the specified format.
+
+    `tsv` and `jsonl` print each row as soon as it's available, while
+    `table` needs all of them to compute the column widths.
+    """
+    if output_format == 'tsv':
+        print('\t'.join(headers))
+        for row in rows:
+            print('\t'.join(_escape_tsv(v) for v in row))
+    elif output_format == 'jsonl':
+        keys = tuple(h.lower() for h in headers)
+        for row in rows:
+            print(json.dumps(dict(zip(keys, row))))
+    else:
+        print(tabulate(tuple(rows), headers=headers, tablefmt='simple'))
+
+
+def _filter_repos(dotfile: Dotfile, match: Optional[str],
+                  action: Optional[str]
+                  ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yields the repos whose name matches `match` and having `action`
+    configured.
+
+    Only the .grony files of the repos matching `match` are read.
+    """
+    key = Action(action).key if action else None
+    for name, repo in dotfile.iter_repos(match):
+        if key and not repo.get(key, None):
+            continue
+        yield (name, repo)
+
+
 @click.group()
 def cli() -> None:
     pass
@@ -61,6 +104,18 @@ def cli() -> None:
 @cli.command()
 @click.option('--reload-delay', type=int, default=5, show_default=True,
               help='Delay between config reloads.')
+@click.option('--max-maintenance', type=int, default=1, show_default=True,
+              help='Max. number of concurrent maintenance runs.')
+@click.option('--drain-timeout', type=int, default=60, show_default=True,
+              help='Seconds to wait for running commands when stopping.')
+@click.option('--profile', is_flag=True, default=False,
+              help='Profiles the scheduler and saves pstats files.')
+@click.option('--profile-every', type=int, default=60, show_default=True,
+              help='Scheduler ticks covered by each pstats file.')
+@click.option('--profile-dir', type=click.Path(dir_okay=True),
+              help='pstats files location (defaults to grony.conf dir).')
+@click.option('--slow-threshold', type=float,
+              help='Logs any phase taking longer than these seconds.')
 @click.option('--log-level',
               type=click.Choice(['DEBUG', 'INFO', 'WARN', 'ERROR'],
                                 case_sensitive=False),
@@ -71,8 +126,10 @@ def cli() -> None:
               type=click.Path(file_okay=True),
               default=DEFAULT_CONF,
               show_default=True, help='grony.conf location.')
-def start(dotfile_path: str, reload_delay: int, log_level: str,
-          log_file: Optional[str] = None) -> None:
+def start(dotfile_path: str, reload_delay: int, max_maintenance: int,
+          drain_timeout: int, profile: bool, profile_every: int,
+          profile_dir: Optional[str], slow_threshold: Optional[float],
+          log_level: str, log_file: Optional[str] = None) -> None:
     """Starts the main process.
     """
 
@@ -82,15 +139,33 @@ def start(dotfile_path: str, reload_delay: int, log_level: str,
 
     logging.info('===== Starting grony =====')
 
-    scheduler_thread = SchedulerThread(dotfile_path, reload_delay)
+    profiling.stats.slow_threshold = slow_threshold
+
+    profiler: Optional[profiling.TickProfiler] = None
+    if profile:
+        if not profile_dir:
+            profile_dir = os.path.dirname(
+                os.path.abspath(os.path.expandvars(dotfile_path)))
+        profiler = profiling.TickProfiler(profile_dir, profile_every)
+
+    scheduler_thread = SchedulerThread(dotfile_path, reload_delay,
+                                       max_maintenance, drain_timeout,
+                                       profiler)
     server_thread = ServerThread(dotfile_path)
 
     def handle_signal(sig: int, frame: Any) -> None:
         name = signal.Signals(sig).name
         logging.info(f'{name} received.')
 
+        if sig == signal.SIGHUP:
+            logging.info('Reloading config...')
+            scheduler_thread.reload()
+            server_thread.reload()
+            return
+
         if scheduler_thread.is_alive():
-            logging.info('Stopping scheduler process...')
+            logging.info('Stopping scheduler process'
+                         ' (waiting for running commands)...')
             scheduler_thread.stop()
 
         if server_thread.is_alive():
@@ -99,6 +174,7 @@ def start(dotfile_path: str, reload_delay: int, log_level: str,
 
     signal.signal(signal.SIGINT, handle_signal)
     signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGHUP, handle_signal)
 
     logging.info('Press Ctrl+C to stop...')
 
@@ -121,8 +197,6 @@ def add(path: str, name: Optional[str], dotfile_path: str):
     """Adds a repository to the .grony.conf file.
     """
 
-    dotfile = load_dotfile(dotfile_path)
-
     if not name:
         _, dirname = os.path.split(os.path.abspath(path))
         default: Optional[str] = None
@@ -131,7 +205,7 @@ def add(path: str, name: Optional[str], dotfile_path: str):
         while not name or not name.strip():
             name = click.prompt("Repository friendly name", default=default)
 
-    client = Client(dotfile)
+    client = Client.connect(dotfile_path)
     try:
         result = client.make_request('add', path=path, name=name)
         _display_result(result)
@@ -149,8 +223,7 @@ def remove(dotfile_path: str, name: str):
     """Removes a repository from the .grony.conf file.
     """
 
-    dotfile = load_dotfile(dotfile_path)
-    client = Client(dotfile)
+    client = Client.connect(dotfile_path)
     try:
         result = client.make_request('remove', name=name)
         _display_result(result)
@@ -171,8 +244,7 @@ def init(autoadd: bool, dotfile_path: str, path: str):
     """Initializes a .grony file in the specified path.
     """
 
-    dotfile = load_dotfile(dotfile_path)
-    client = Client(dotfile)
+    client = Client.connect(dotfile_path)
     try:
         result = client.make_request('init', path=path)
         _display_result(result)
@@ -188,19 +260,58 @@ def init(autoadd: bool, dotfile_path: str, path: str):
               type=click.Path(file_okay=True),
               default=DEFAULT_CONF,
               show_default=True, help='grony.conf location.')
-def list(dotfile_path: str):
+@click.option('--format', 'output_format',
+              type=click.Choice(['table', 'tsv', 'jsonl']),
+              default='table', show_default=True,
+              help='Output format. tsv and jsonl are streamed.')
+@click.option('--match', help='Only repositories whose name matches'
+              ' this glob pattern.')
+@click.option('--action', type=click.Choice(ACTION_NAMES),
+              help='Only repositories with this action configured.')
+def list(dotfile_path: str, output_format: str, match: Optional[str],
+         action: Optional[str]):
     """List all configured repositories.
     """
 
-    dotfile = load_dotfile(dotfile_path)
-    items = tuple((name, repo.get('path'))
-                  for (name, repo) in dotfile.get_repos().items())
-    print(tabulate(items, headers=('Name', 'Path'), tablefmt='simple'))
+    dotfile = load_dotfile(dotfile_path, with_defaults=False)
+
+    # The path is always in the main config, so there's no need to read
+    # any .grony file unless we filter by action.
+    rows: Iterator[Tuple[str, Optional[str]]]
+    if action:
+        rows = ((name, repo.get('path', None))
+                for name, repo in _filter_repos(dotfile, match, action))
+    else:
+        rows = ((name, dotfile.get_repo_path(name))
+                for name in dotfile.iter_repo_names(match))
+
+    _print_rows(rows, ('Name', 'Path'), output_format)
+
+
+@cli.command()
+@click.option('--dotfile', 'dotfile_path',
+              type=click.Path(file_okay=True),
+              default=DEFAULT_CONF,
+              show_default=True, help='grony.conf location.')
+def stats(dotfile_path: str):
+    """Show the scheduler timings.
+    """
+
+    client = Client.connect(dotfile_path)
+    try:
+        result = client.make_request('debug/stats')
+        print(json.dumps(result, indent=2))
+    except URLError as e:
+        fatal(str(e.reason))
 
 
 @cli.command()
 @click.option('--ini', 'ini_format', is_flag=True, default=False,
               help='Uses an output format suitable for config files')
+@click.option('--format', 'output_format',
+              type=click.Choice(['table', 'tsv', 'jsonl']),
+              default='table', show_default=True,
+              help='Output format. tsv and jsonl are streamed.')
 @click.option('--dotfile', 'dotfile_path',
               type=click.Path(file_okay=True),
               default=DEFAULT_CONF,
@@ -208,16 +319,49 @@ def list(dotfile_path: str):
 @click.option('--all', 'show_all', is_flag=True,
               default=False,
               help='Display all repositories')
+@click.option('--match', help='With --all, only repositories whose name'
+              ' matches this glob pattern.')
+@click.option('--action', type=click.Choice(ACTION_NAMES),
+              help='With --all, only repositories with this action'
+              ' configured.')
 @click.argument('name', type=str, required=False)
-def show(ini_format, dotfile_path: str, show_all: bool, name: str):
+def show(ini_format: bool, output_format: str, dotfile_path: str,
+         show_all: bool, match: Optional[str], action: Optional[str],
+         name: Optional[str]):
     """Show the effective settings for a repository.
     """
 
-    dotfile = load_dotfile(dotfile_path)
+    dotfile = load_dotfile(dotfile_path, with_defaults=False)
 
-    items = dotfile.get_repo(name).items()
-    if ini_format:
-        for k, v in items:
-            print(f'{k} = {v}')
+    repos: Iterator[Tuple[str, Dict[str, Any]]]
+    if show_all:
+        repos = _filter_repos(dotfile, match, action)
+    elif name:
+        repos = iter(((name, dotfile.get_repo(name)),))
     else:
-        print(tabulate(items, headers=('Key', 'Value'), tablefmt='simple'))
+        fatal('Missing repository name (or use --all).')
+        return
+
+    if output_format == 'tsv' and not ini_format:
+        _print_rows(((repo_name, k, v)
+                     for repo_name, repo in repos
+                     for k, v in repo.items()),
+                    ('Name', 'Key', 'Value'), output_format)
+        return
+
+    for i, (repo_name, repo) in enumerate(repos):
+        if output_format == 'jsonl' and not ini_format:
+            print(json.dumps(repo))
+            continue
+
+        if show_all:
+            if i > 0:
+                print()
+            print(f"[repo '{repo_name}']" if ini_format else repo_name)
+
+        if ini_format:
+            for k, v in repo.items():
+                print(f'{k} = {v}')
+        else:
+            print(tabulate(repo.items(), headers=('Key', 'Value'),
+                           tablefmt='simple'))
@@ -1,30 +1,79 @@
 import json
+import logging
 import urllib.request
 
-from urllib.error import HTTPError
+from urllib.error import HTTPError, URLError
 
-from grony.dotfile import Dotfile
+from grony.dotfile import Dotfile, load_dotfile
+from grony.runtime import get_runtime_path, load_runtime
 
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 
 class Client:
-    def __init__(self, dotfile: Dotfile) -> None:
-        self.dotfile = dotfile
+
+    # Clients by grony.conf path, so consecutive requests in the same
+    # process don't read the runtime descriptor or config again.
+    _cache: Dict[str, 'Client'] = {}
+
+    def __init__(self, host: str, port: int, secret: str,
+                 dotfile_path: Optional[str] = None) -> None:
+        self.host = host
+        self.port = port
+        self.secret = secret
+        # grony.conf to fall back to, for clients using a runtime
+        # descriptor which may be stale
+        self.dotfile_path = dotfile_path
+
+    @classmethod
+    def from_dotfile(cls, dotfile: Dotfile) -> 'Client':
+        return cls('127.0.0.1',
+                   dotfile.getint('config', 'ipc_port'),
+                   dotfile.get('config', 'secret'))
+
+    @classmethod
+    def connect(cls, dotfile_path: str) -> 'Client':
+        """Returns a client for the server using `dotfile_path`.
+
+        Uses the runtime descriptor published by the running server and
+        only falls back to read grony.conf if there's none.
+        """
+        client = cls._cache.get(dotfile_path, None)
+        if client:
+            return client
+
+        runtime = load_runtime(get_runtime_path(dotfile_path))
+        if runtime:
+            client = cls(runtime['host'], runtime['port'], runtime['secret'],
+                         dotfile_path)
+        else:
+            client = cls.from_dotfile(load_dotfile(dotfile_path))
+
+        cls._cache[dotfile_path] = client
+        return client
 
     def make_request(self, endpoint: str, **kwargs) -> Dict[str, Any]:
-        port: int = self.dotfile.getint('config', 'ipc_port')
-        secret: str = self.dotfile.get('config', 'secret')
-        host: str = '127.0.0.1'
         data: bytes = urllib.parse.urlencode(kwargs).encode()
 
         req = urllib.request.Request(
-            f'http://{host}:{port}/grony/{endpoint}',
+            f'http://{self.host}:{self.port}/grony/{endpoint}',
             data=data, method='POST')
-        req.add_header('Authorization', f"Bearer {secret}")
+        req.add_header('Authorization', f"Bearer {self.secret}")
 
         try:
             response = urllib.request.urlopen(req)
             return json.loads(response.read().decode())
         except HTTPError as e:
             return json.loads(e.read())
+        except URLError as e:
+            if not self.dotfile_path:
+                raise
+
+            # The server which wrote the descriptor may be dead, with its
+            # pid reused by another process. Try again with grony.conf.
+            logging.debug(f'Ignoring runtime descriptor: {e}')
+            client = self.from_dotfile(load_dotfile(self.dotfile_path))
+            self.host, self.port, self.secret = \
+                client.host, client.port, client.secret
+            self.dotfile_path = None
+            return self.make_request(endpoint, **kwargs)
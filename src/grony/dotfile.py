@@ -4,9 +4,13 @@ import uuid
 import logging
 import configparser
 
+from fnmatch import fnmatchcase
 from pathlib import Path
 
-from typing import Any, Dict
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+
+REPO_SECTION_RE = re.compile(r"^\s*repo\s+'([^']+)'\s*$")
 
 
 class Dotfile(configparser.RawConfigParser):
@@ -31,15 +35,44 @@ class Dotfile(configparser.RawConfigParser):
         return self[key]
 
     def get_repos(self) -> Dict[str, Dict[str, Any]]:
-        return dict((match.group(1), self.get_repo(match.group(1)))
-                    for match in (re.match(r"^\s*repo\s+'([^']+)'\s*$", s)
-                                  for s in self.sections())
-                    if match)
+        return dict(self.iter_repos())
+
+    def iter_repo_names(self, pattern: Optional[str] = None) -> Iterator[str]:
+        """Yields the name of every repo matching the glob `pattern`.
+
+        Doesn't read any .grony file.
+        """
+        for section in self.sections():
+            match = REPO_SECTION_RE.match(section)
+            if not match:
+                continue
+
+            name = match.group(1)
+            if pattern and not fnmatchcase(name, pattern):
+                continue
+
+            yield name
+
+    def iter_repos(self, pattern: Optional[str] = None
+                   ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Yields the effective settings of every repo matching the glob
+        `pattern`, reading their .grony files one at a time.
+        """
+        for name in self.iter_repo_names(pattern):
+            yield (name, self.get_repo(name))
 
     def has_repo(self, name: str) -> bool:
         key = self._get_repo_key(name)
         return self.has_section(key)
 
+    def get_repo_path(self, name: str) -> Optional[str]:
+        """Returns the repo path without reading its .grony file.
+        """
+        key = self._get_repo_key(name)
+        if not self.has_section(key):
+            return None
+        return self[key].get('path', None)
+
     def get_repo(self, name: str) -> Dict[str, Any]:
         key = self._get_repo_key(name)
         if not self.has_section(key):
@@ -82,6 +115,12 @@ def _expand(path: str) -> str:
     return os.path.abspath(os.path.expandvars(path))
 
 
+def get_sibling_path(dotfile_path: str, name: str) -> str:
+    """Returns the path of the file `name` next to a grony.conf.
+    """
+    return str(Path(_expand(dotfile_path)).parent.joinpath(name))
+
+
 def _load_dotfile(path: str) -> Dotfile:
     return Dotfile(_expand(path))
 
@@ -0,0 +1,114 @@
+import os
+import time
+import cProfile
+import logging
+
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+
+from typing import Any, Deque, Dict, Iterator, Optional
+
+
+class Stats:
+    """Thread-safe registry with the timings of each instrumented phase.
+    """
+
+    MAX_SLOW_ENTRIES = 50
+
+    def __init__(self) -> None:
+        self.slow_threshold: Optional[float] = None
+        self._phases: Dict[str, Dict[str, Any]] = {}
+        self._slow: Deque[Dict[str, Any]] = deque(maxlen=self.MAX_SLOW_ENTRIES)
+        self._lock = Lock()
+
+    def record(self, phase: str, elapsed: float,
+               repo: Optional[str] = None) -> None:
+        now = datetime.now().isoformat()
+
+        with self._lock:
+            entry = self._phases.get(phase, None)
+            if not entry:
+                entry = {'count': 0, 'total': 0.0, 'max': 0.0}
+                self._phases[phase] = entry
+
+            entry['count'] += 1
+            entry['total'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+            entry['last'] = elapsed
+            entry['last_repo'] = repo
+            entry['last_at'] = now
+
+            is_slow = self.slow_threshold is not None \
+                and elapsed >= self.slow_threshold
+            if is_slow:
+                self._slow.append({'phase': phase, 'repo': repo,
+                                   'elapsed': elapsed, 'at': now})
+
+        if is_slow:
+            target = f" for '{repo}'" if repo else ''
+            logging.warning(f'Slow {phase}{target}: {elapsed:.3f}s')
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'phases': dict((k, dict(v)) for k, v in self._phases.items()),
+                'slow': list(self._slow),
+            }
+
+
+stats = Stats()
+
+
+@contextmanager
+def span(phase: str, repo: Optional[str] = None) -> Iterator[None]:
+    """Measures the wrapped block and records it in `stats`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.record(phase, time.perf_counter() - start, repo)
+
+
+class TickProfiler:
+    """Profiles the calling thread and dumps pstats files every N ticks.
+    """
+
+    def __init__(self, output_dir: str, every_ticks: int) -> None:
+        self.output_dir = output_dir
+        self.every_ticks = max(1, every_ticks)
+        self._ticks = 0
+        self._profile: Optional[cProfile.Profile] = None
+
+    def start(self) -> None:
+        try:
+            os.makedirs(self.output_dir)
+        except Exception as ex:
+            logging.debug(f'While calling makedirs(): {ex}')
+
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def tick(self) -> None:
+        self._ticks += 1
+        if self._ticks % self.every_ticks == 0:
+            self.stop()
+            self.start()
+
+    def stop(self) -> None:
+        if not self._profile:
+            return
+
+        self._profile.disable()
+
+        name = datetime.now().strftime('grony-%Y%m%d-%H%M%S.pstats')
+        path = os.path.join(self.output_dir, name)
+        try:
+            self._profile.dump_stats(path)
+            logging.info(f'Profile saved to {path}')
+        except Exception as ex:
+            logging.warning(f"Can't save profile to {path}: {ex}")
+
+        self._profile = None
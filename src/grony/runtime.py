@@ -0,0 +1,76 @@
+import os
+import json
+import logging
+
+from grony.dotfile import get_sibling_path
+
+from typing import Any, Dict, Optional
+
+
+def get_runtime_path(dotfile_path: str) -> str:
+    """Returns the path of the runtime descriptor for a grony.conf.
+    """
+    return get_sibling_path(dotfile_path, 'grony.runtime')
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except PermissionError:
+        return True
+    except Exception:
+        return False
+
+
+def load_runtime(path: str) -> Optional[Dict[str, Any]]:
+    """Loads the descriptor published by a running server.
+
+    Returns `None` if there's no descriptor or the server which wrote it
+    is not running anymore.
+    """
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        host = str(data['host'])
+        port = int(data['port'])
+        secret = str(data['secret'])
+        pid = int(data['pid'])
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logging.debug(f'Ignoring runtime descriptor {path}: {ex}')
+        return None
+
+    if not _is_alive(pid):
+        logging.debug(f'Ignoring stale runtime descriptor {path}')
+        return None
+
+    return {'host': host, 'port': port, 'secret': secret, 'pid': pid}
+
+
+def save_runtime(path: str, host: str, port: int, secret: str) -> None:
+    logging.debug(f'Saving runtime descriptor to {path}...')
+
+    data = {'host': host, 'port': port, 'secret': secret, 'pid': os.getpid()}
+
+    # The descriptor contains the secret, so only the owner can read it
+    tmp_path = f'{path}.tmp'
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # The mode above only applies if the file is created
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except Exception as ex:
+        logging.warning(f"Can't save runtime descriptor to {path}: {ex}")
+
+
+def remove_runtime(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception as ex:
+        logging.warning(f"Can't remove runtime descriptor {path}: {ex}")
@@ -1,102 +1,756 @@
 import os
+import re
+import sys
+import json
+import shlex
+import signal
 import time
 import logging
 import subprocess
 
 from datetime import datetime, timedelta
-from threading import Thread
-from collections import namedtuple
+from enum import Enum
+from queue import Queue
+from threading import Lock, Thread, Timer
 
-from grony.dotfile import Dotfile, load_dotfile
+from grony.dotfile import Dotfile, get_sibling_path, load_dotfile
+from grony.profiling import TickProfiler, span, stats
 
 from crontab import CronTab  # type: ignore
 
-from typing import Any, Dict, List, Optional, cast
+from typing import Any, Dict, List, Optional, Set, Tuple, cast
 
 
-RunInfo = namedtuple('RunInfo', ['datetime', 'action', 'repo_data'])
+class Action(Enum):
+    # Declaration order is the run order for actions due at the same time
+    PULL = 'pull'
+    COMMIT = 'commit'
+    PUSH = 'push'
+    MAINTAIN = 'maintain'
+
+    @property
+    def key(self) -> str:
+        """Returns the config key holding the action crontab expression.
+        """
+        return f'{self.value}-on'
+
+
+ACTION_ORDER = dict((action, i) for i, action in enumerate(Action))
+
+
+def _get_number(config: Dict[str, str], key: str, type_: type,
+                default: Any) -> Any:
+    value = config.get(key, None)
+    if not value:
+        return default
+
+    try:
+        return type_(value)
+    except ValueError:
+        logging.warning(f"Invalid '{key}' value '{value}'"
+                        f" for '{config['name']}'")
+        return default
+
+
+# (remote name, remote url, object store path)
+PullSource = Tuple[str, str, str]
+
+
+class RepoTable:
+    """Shared table with the effective config of every scheduled repo.
+
+    Runs only keep the integer id of their repo, so there's a single
+    copy of each config no matter how many actions it has. Keys and
+    values are interned, as most of them are repeated across repos.
+    """
+
+    __slots__ = ('_configs', '_paths', '_priorities', '_max_latencies')
+
+    def __init__(self) -> None:
+        self._configs: List[Dict[str, str]] = []
+        self._paths: List[Optional[str]] = []
+        self._priorities: List[int] = []
+        self._max_latencies: List[Optional[timedelta]] = []
+
+    def add(self, repo: Dict[str, Any]) -> int:
+        config = dict((sys.intern(k), sys.intern(v)
+                       if isinstance(v, str) else v)
+                      for k, v in repo.items())
+
+        path: Optional[str] = config.get('path', None)
+        if path:
+            path = os.path.abspath(os.path.expandvars(path))
+
+        max_latency = _get_number(config, 'max-latency', float, None)
+
+        repo_id = len(self._configs)
+        self._configs.append(config)
+        self._paths.append(path)
+        self._priorities.append(_get_number(config, 'priority', int, 0))
+        self._max_latencies.append(timedelta(seconds=max_latency)
+                                   if max_latency is not None else None)
+        return repo_id
+
+    def get(self, repo_id: int) -> Dict[str, str]:
+        return self._configs[repo_id]
+
+    def get_name(self, repo_id: int) -> str:
+        return self._configs[repo_id]['name']
+
+    def get_path(self, repo_id: int) -> Optional[str]:
+        return self._paths[repo_id]
+
+    def get_priority(self, repo_id: int) -> int:
+        return self._priorities[repo_id]
+
+    def get_max_latency(self, repo_id: int) -> Optional[timedelta]:
+        return self._max_latencies[repo_id]
+
+    def __len__(self) -> int:
+        return len(self._configs)
+
+
+class RunInfo:
+    """A scheduled action for a repo.
+    """
+
+    __slots__ = ('datetime', 'action', 'repo_id', 'cron_expr', 'last_run')
+
+    def __init__(self, datetime: datetime, action: Action,
+                 repo_id: int, cron_expr: str,
+                 last_run: Optional[datetime] = None) -> None:
+        self.datetime = datetime
+        self.action = action
+        self.repo_id = repo_id
+        self.cron_expr = cron_expr
+        self.last_run = last_run
+
+
+# (repo name, action, crontab expression)
+RunKey = Tuple[str, Action, str]
+
+# (next run, last run)
+RunTimes = Tuple[datetime, Optional[datetime]]
+
+# (repo config, repo path)
+MaintenanceRun = Tuple[Dict[str, str], Optional[str]]
+
+
+class PullGroup:
+    """Due pulls of repos sharing the same remote url.
+
+    The remote is fetched once, by the first run of the group to be
+    dequeued. The rest of repos only need to be updated locally.
+    """
+
+    __slots__ = ('url', 'sources', 'remote', 'store', 'fetched',
+                 'fetched_stores')
+
+    def __init__(self, url: str, sources: Dict[int, PullSource]) -> None:
+        self.url = url
+        # Pull source of each repo in the group, by repo id
+        self.sources = sources
+        # Remote name and object store of the repo which fetched
+        self.remote = ''
+        self.store = ''
+        self.fetched: Optional[bool] = None
+        self.fetched_stores: Set[str] = set()
+
+
+def get_state_path(dotfile_path: str) -> str:
+    """Returns the path of the scheduler state file for a grony.conf.
+    """
+    return get_sibling_path(dotfile_path, 'grony.state')
+
+
+def load_state(path: str) -> Dict[RunKey, RunTimes]:
+    """Loads the scheduled runs saved by `save_state`.
+    """
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as ex:
+        logging.warning(f"Can't load scheduler state from {path}: {ex}")
+        return {}
+
+    result: Dict[RunKey, RunTimes] = {}
+    for entry in data.get('runs', []):
+        try:
+            key = (entry['repo'], Action(entry['action']), entry['cron'])
+            last_run = entry.get('last', None)
+            result[key] = (datetime.fromisoformat(entry['next']),
+                           datetime.fromisoformat(last_run)
+                           if last_run else None)
+        except Exception as ex:
+            logging.debug(f'Ignoring state entry {entry}: {ex}')
+
+    return result
+
+
+def save_state(path: str, runs: Dict[RunKey, RunTimes]) -> None:
+    logging.debug(f'Saving scheduler state to {path}...')
+
+    data = {
+        'saved': datetime.now().isoformat(),
+        'runs': [{'repo': repo_name,
+                  'action': action.value,
+                  'cron': cron_expr,
+                  'next': next_run.isoformat(),
+                  'last': last_run.isoformat() if last_run else None}
+                 for (repo_name, action, cron_expr), (next_run, last_run)
+                 in runs.items()]
+    }
+
+    # Write to a temp file first to never leave a truncated state behind
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except Exception as ex:
+        logging.warning(f"Can't save scheduler state to {path}: {ex}")
+
+
+# `git maintenance` is only available since git 2.29. Fall back to the
+# classic housekeeping commands on older versions.
+MAINTAIN_COMMAND = 'git maintenance run --auto' \
+    ' || (git gc --auto && git commit-graph write --reachable)'
+
+
+# Integrates the already fetched upstream branch. Pulling from the local
+# repo ('.') honors the user's pull settings ('pull.rebase', 'pull.ff',
+# ...) without going to the network again.
+LOCAL_PULL_COMMAND = \
+    'git pull . "$(git rev-parse --symbolic-full-name @{u})"'
 
 
 class SchedulerThread(Thread):
     def __init__(self, dotfile_path: str,
-                 reload_delay_seconds: int) -> None:
+                 reload_delay_seconds: int,
+                 max_maintenance: int = 1,
+                 drain_timeout_seconds: int = 60,
+                 profiler: Optional[TickProfiler] = None) -> None:
         super().__init__()
         self.dotfile_path = dotfile_path
         self.reload_delay = reload_delay_seconds
+        self.profiler = profiler
+        self.drain_timeout = drain_timeout_seconds
+        self.state_path = get_state_path(dotfile_path)
         self._running = False
-
-    def _schedule_next(self, dotfile: Dotfile,
-                       since: datetime) -> List[RunInfo]:
+        self._reload_requested = False
+        self._drain_timer: Optional[Timer] = None
+
+        # Running git processes, to terminate them if draining takes
+        # too much time.
+        self._processes: Set[subprocess.Popen] = set()
+        self._processes_guard = Lock()
+
+        self._repos = RepoTable()
+        self._crontabs: Dict[str, CronTab] = {}
+
+        # Maintenance runs in a fixed pool of background workers, so we
+        # need to make sure it never overlaps with any other action in the
+        # same repo. Nobody waits for a repo lock: busy repos are skipped,
+        # so the main loop never waits for maintenance.
+        #
+        # Locks are by object store, which worktrees share with their main
+        # checkout. Stores are cached by repo path, as they don't change.
+        self._repo_locks: Dict[str, Lock] = {}
+        self._repo_locks_guard = Lock()
+        self._object_stores: Dict[str, str] = {}
+        self._maintenance_queue: 'Queue[Optional[MaintenanceRun]]' = Queue()
+        self._maintenance_queued: Set[str] = set()
+        self._maintenance_workers = [
+            Thread(target=self._maintenance_worker, name=f'maintain-{i}',
+                   daemon=True)
+            for i in range(max(1, max_maintenance))]
+
+    def _get_object_store(self, path: str) -> Optional[str]:
+        store = self._object_stores.get(path, None)
+        if store:
+            return store
+
+        output = self._git_output(path, 'rev-parse', '--git-common-dir')
+        if not output:
+            return None
+
+        store = os.path.realpath(os.path.join(path, output))
+        self._object_stores[path] = store
+        return store
+
+    def _get_repo_lock(self, repo_name: str, path: Optional[str]) -> Lock:
+        # Repos we can't resolve (yet) are locked by name
+        key = (self._get_object_store(path) if path else None) or repo_name
+        with self._repo_locks_guard:
+            lock = self._repo_locks.get(key, None)
+            if not lock:
+                lock = Lock()
+                self._repo_locks[key] = lock
+            return lock
+
+    def _next_datetime(self, cron_expr: str, since: datetime) -> datetime:
+        crontab = self._crontabs.get(cron_expr, None)
+        if not crontab:
+            crontab = CronTab(cron_expr)
+            self._crontabs[cron_expr] = crontab
+
+        pending_seconds = crontab.next(since, default_utc=False)
+        return since + timedelta(seconds=pending_seconds)
+
+    def _get_run_times(self, runs: List[RunInfo]
+                       ) -> Dict[RunKey, RunTimes]:
+        return dict(((self._repos.get_name(run.repo_id), run.action,
+                      run.cron_expr), (run.datetime, run.last_run))
+                    for run in runs)
+
+    def _schedule_next(self, dotfile: Dotfile, since: datetime,
+                       known: Optional[Dict[RunKey, RunTimes]] = None
+                       ) -> List[RunInfo]:
         """Returns one RunInfo entry for each action in all repos.
+
+        Actions already present in `known` with the same crontab
+        expression keep their scheduled time.
         """
         since = since.replace(second=0, microsecond=0)
+        known = known or {}
 
+        repos = RepoTable()
+        self._crontabs = {}
         result: List[RunInfo] = []
 
         for repo in dotfile.get_repos().values():
+            repo_id = repos.add(repo)
+            repo = repos.get(repo_id)
             repo_name = repo['name']
 
             logging.debug(f"Checking actions for '{repo_name}'...")
-            for key in ('pull-on', 'commit-on', 'push-on'):
-                cron_expr: Optional[str] = repo.get(key, None)
+            for action in Action:
+                cron_expr: Optional[str] = repo.get(action.key, None)
                 if not cron_expr:
                     continue
 
-                pending_seconds = CronTab(cron_expr).next(since,
-                                                          default_utc=False)
-                next_run = since + timedelta(seconds=pending_seconds)
+                times = known.get((repo_name, action, cron_expr), None)
+                if times:
+                    next_run, last_run = times
+                else:
+                    next_run = self._next_datetime(cron_expr, since)
+                    last_run = None
 
-                info = RunInfo(next_run, key.replace('-on', ''), repo)
+                info = RunInfo(next_run, action, repo_id, cron_expr,
+                               last_run)
                 result.append(info)
                 logging.debug(
-                    f'  - Scheduled {info.action} on {info.datetime}')
+                    f'  - Scheduled {action.value} on {info.datetime}')
 
+        self._repos = repos
         return result
 
+    def _reschedule(self, runs: List[RunInfo], since: datetime) -> None:
+        """Updates in place the scheduled time of the given runs.
+        """
+        since = since.replace(second=0, microsecond=0)
+        for run in runs:
+            run.last_run = run.datetime
+            run.datetime = self._next_datetime(run.cron_expr, since)
+
     def _perform_run(self, rinfo: RunInfo) -> bool:
-        repo: Dict[str, Any] = cast(Dict[str, Any], rinfo.repo_data)
+        return self._perform_locked_run(rinfo.action,
+                                        self._repos.get(rinfo.repo_id),
+                                        self._repos.get_path(rinfo.repo_id))
+
+    def _perform_locked_run(self, action: Action, repo: Dict[str, str],
+                            path: Optional[str]) -> bool:
         repo_name: str = repo['name']
 
-        logging.info(f"Running '{rinfo.action}' for '{repo_name}'...")
+        logging.info(f"Running '{action.value}' for '{repo_name}'...")
 
-        path: Optional[str] = repo.get('path', None)
         if not path:
             logging.warning("  - Missing 'path' key!")
             return False
 
-        path = os.path.abspath(os.path.expandvars(path))
-
         command: Optional[str] = None
-        if rinfo.action == 'pull':
+        if action == Action.PULL:
             remote = repo.get('pull-remote', '')
             command = f'git pull {remote}'
-        elif rinfo.action == 'commit':
+        elif action == Action.COMMIT:
             message = datetime.now().strftime(
                 repo.get('commit-message', 'Auto commit at %Y%m%d %H:%M:%S'))
             command = f'git add -A && git commit -m "{message}"'
-        elif rinfo.action == 'push':
+        elif action == Action.PUSH:
             remote = repo.get('push-remote', '')
             command = f'git push {remote}'
+        elif action == Action.MAINTAIN:
+            command = MAINTAIN_COMMAND
         else:
-            logging.warning(f"  - Invalid action '{rinfo.action}'!")
+            logging.warning(f"  - Invalid action '{action}'!")
             return False
 
+        with span(f'run:{action.value}', repo_name):
+            if not self._run_command(command, path):
+                return False
+
+        logging.info("Finished")
+        return True
+
+    def _run_command(self, command: str, path: str,
+                     quiet: bool = False) -> bool:
         try:
-            subprocess.run(command, shell=True, check=True, cwd=path)
-            logging.info("Finished")
+            # Run in a new session, so a Ctrl+C in the terminal doesn't
+            # interrupt the command while we are draining.
+            process = subprocess.Popen(command, shell=True, cwd=path,
+                                       start_new_session=True)
+            with self._processes_guard:
+                self._processes.add(process)
+            try:
+                returncode = process.wait()
+            finally:
+                with self._processes_guard:
+                    self._processes.discard(process)
+
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, command)
             return True
         except Exception as ex:
-            logging.exception(ex)
+            if quiet:
+                logging.debug(str(ex))
+            else:
+                logging.exception(ex)
+            return False
+
+    def _git_output(self, path: str, *args: str) -> Optional[str]:
+        try:
+            result = subprocess.run(('git',) + args, cwd=path, check=True,
+                                    capture_output=True, text=True)
+            return result.stdout.strip()
+        except Exception as ex:
+            logging.debug(str(ex))
+            return None
+
+    def _resolve_pull_source(self, path: str,
+                             remote: str) -> Optional[PullSource]:
+        """Returns the remote name, remote url and object store path
+        for a repo, or `None` if its pulls can't be shared.
+
+        The remote is the one of the current branch upstream, as the
+        shared pull merges `@{u}`. A `remote` other than that one (from
+        `pull-remote`) can't be shared.
+        """
+        output = self._git_output(path, 'rev-parse', '--git-common-dir',
+                                  '--symbolic-full-name', 'HEAD')
+        config = self._git_output(path, 'config', '--list', '-z')
+        if not output or config is None:
+            return None
+
+        store, _, head = output.partition('\n')
+        if not head.startswith('refs/heads/'):
+            return None
+
+        values = dict(entry.partition('\n')[::2]
+                      for entry in config.split('\0'))
+        branch = head[len('refs/heads/'):]
+        upstream = values.get(f'branch.{branch}.remote', '')
+        if not upstream or upstream == '.' \
+                or (remote and remote != upstream):
+            return None
+
+        url = values.get(f'remote.{upstream}.url', '')
+        if not url:
+            return None
+
+        # Local remotes can be referenced with different relative paths
+        if '://' not in url and not re.match(r'^[^/]+:', url):
+            url = os.path.realpath(os.path.join(path, url))
+
+        return (upstream, url, os.path.realpath(os.path.join(path, store)))
+
+    def _mark_done(self, run: RunInfo, success: bool,
+                   done: List[RunInfo]) -> None:
+        # Runs failing while stopping were probably terminated, so they
+        # stay due and are saved as pending.
+        if success or self._running:
+            done.append(run)
+
+    def _queue_runs(self, runs: List[RunInfo],
+                    now: datetime) -> List[RunInfo]:
+        """Returns the due runs in dispatch order.
+
+        Runs are sorted by repo priority (higher first) and then by
+        deadline (scheduled time + repo `max-latency`). Runs of the same
+        repo due at the same time keep the pull, commit, push order.
+
+        There's a single run for each repo and action, so fires missed
+        while busy or stopped are never queued more than once: the run
+        is performed once and then rescheduled from now.
+        """
+        for run in runs:
+            if self._next_datetime(run.cron_expr, run.datetime) <= now:
+                logging.info(f"'{run.action.value}' for"
+                             f" '{self._repos.get_name(run.repo_id)}'"
+                             ' missed some fires. Running it once.')
+
+        def sort_key(run: RunInfo) -> Tuple[int, datetime, datetime, int]:
+            max_latency = self._repos.get_max_latency(run.repo_id)
+            deadline = run.datetime + max_latency \
+                if max_latency is not None else datetime.max
+            return (-self._repos.get_priority(run.repo_id), deadline,
+                    run.datetime, ACTION_ORDER[run.action])
+
+        return sorted(runs, key=sort_key)
+
+    def _check_latency(self, run: RunInfo) -> None:
+        """Reports runs starting later than their repo `max-latency`.
+        """
+        max_latency = self._repos.get_max_latency(run.repo_id)
+        if max_latency is None:
+            return
+
+        latency = datetime.now() - run.datetime
+        if latency <= max_latency:
+            return
+
+        repo_name = self._repos.get_name(run.repo_id)
+        stats.record(f'missed-latency:{run.action.value}',
+                     latency.total_seconds(), repo_name)
+        logging.warning(f"'{run.action.value}' for '{repo_name}' started"
+                        f' {latency.total_seconds():.0f}s late (max-latency'
+                        f' is {max_latency.total_seconds():.0f}s)')
+
+    def _group_pulls(self, runs: List[RunInfo]) -> Dict[RunInfo, PullGroup]:
+        """Maps every pull run sharing its remote with other due pulls to
+        the group of all of them.
+
+        Sources are resolved here, and only if there's more than one due
+        pull, so they're never stale and lone pulls don't run git twice.
+        """
+        if len(runs) < 2:
+            return {}
+
+        by_url: Dict[str, Dict[RunInfo, PullSource]] = {}
+        for run in runs:
+            path = self._repos.get_path(run.repo_id)
+            if not path:
+                continue
+
+            remote = self._repos.get(run.repo_id).get('pull-remote', '')
+            source = self._resolve_pull_source(path, remote)
+            if source:
+                by_url.setdefault(source[1], {})[run] = source
+
+        result: Dict[RunInfo, PullGroup] = {}
+        for url, group_runs in by_url.items():
+            if len(group_runs) < 2:
+                continue
+
+            group = PullGroup(url, dict((run.repo_id, source) for run, source
+                                        in group_runs.items()))
+            for run in group_runs:
+                result[run] = group
+
+        return result
+
+    def _perform_pull(self, rinfo: RunInfo,
+                      group: Optional[PullGroup]) -> bool:
+        """Performs a pull run, sharing the fetch with the rest of its
+        group, if any.
+        """
+        if not group:
+            return self._perform_run(rinfo)
+
+        if group.fetched is None:
+            group.fetched = self._fetch_group(rinfo, group)
+
+        if not group.fetched:
+            return self._perform_run(rinfo)
+
+        return self._perform_local_pull(rinfo, group)
+
+    def _fetch_group(self, rinfo: RunInfo, group: PullGroup) -> bool:
+        logging.info(f"Fetching '{group.url}'"
+                     f' for {len(group.sources)} repos...')
+
+        remote, _, store = group.sources[rinfo.repo_id]
+        repo_name = self._repos.get_name(rinfo.repo_id)
+        path = cast(str, self._repos.get_path(rinfo.repo_id))
+
+        with span('run:fetch', repo_name):
+            fetched = self._run_command(f'git fetch {remote}', path)
+
+        if not fetched:
+            logging.warning('  - Fetch failed. Pulling each repo instead.')
             return False
 
+        # Worktrees share the object store (and refs) with their main
+        # checkout, so they only need to be fetched once.
+        group.remote = remote
+        group.store = store
+        group.fetched_stores.add(store)
+        return True
+
+    def _perform_local_pull(self, rinfo: RunInfo, group: PullGroup) -> bool:
+        repo = self._repos.get(rinfo.repo_id)
+        path = cast(str, self._repos.get_path(rinfo.repo_id))
+        remote, _, store = group.sources[rinfo.repo_id]
+
+        logging.info(f"Running 'pull' for '{repo['name']}'"
+                     ' (shared fetch)...')
+
+        fetched = True
+        with span('run:pull', repo['name']):
+            if store not in group.fetched_stores:
+                refspec = f'+refs/remotes/{group.remote}/*' \
+                    f':refs/remotes/{remote}/*'
+                fetched = self._run_command(
+                    f'git fetch {shlex.quote(group.store)} "{refspec}"', path)
+                if fetched:
+                    group.fetched_stores.add(store)
+
+            success = fetched and self._run_command(LOCAL_PULL_COMMAND, path)
+
+        if not fetched:
+            logging.info('  - Local fetch failed.'
+                         ' Running a regular pull.')
+            return self._perform_locked_run(Action.PULL, repo, path)
+
+        if success:
+            logging.info("Finished")
+        return success
+
+    def _start_maintenance(self, rinfo: RunInfo) -> None:
+        """Queues a maintenance run for the background workers.
+
+        The run is skipped if the repo already has one queued.
+        """
+        # Resolve the repo here, as the table can be replaced by a
+        # reload before a worker takes the run
+        repo = self._repos.get(rinfo.repo_id)
+        path = self._repos.get_path(rinfo.repo_id)
+        repo_name = repo['name']
+
+        with self._repo_locks_guard:
+            if repo_name in self._maintenance_queued:
+                logging.info(f"Skipping 'maintain' for '{repo_name}'"
+                             ' (already queued)')
+                return
+            self._maintenance_queued.add(repo_name)
+
+        self._maintenance_queue.put((repo, path))
+
+    def _maintenance_worker(self) -> None:
+        while True:
+            item = self._maintenance_queue.get()
+            if item is None:
+                return
+
+            repo, path = item
+            repo_name = repo['name']
+            with self._repo_locks_guard:
+                self._maintenance_queued.discard(repo_name)
+
+            if not self._running:
+                continue
+
+            # Never wait for the repo: it's busy with a regular run
+            lock = self._get_repo_lock(repo_name, path)
+            if not lock.acquire(blocking=False):
+                logging.info(f"Skipping 'maintain' for '{repo_name}'"
+                             ' (repo is busy)')
+                continue
+
+            try:
+                self._perform_locked_run(Action.MAINTAIN, repo, path)
+            finally:
+                lock.release()
+
+    def _dispatch(self, due_runs: List[RunInfo], now: datetime,
+                  done: List[RunInfo]) -> int:
+        """Performs the due runs in queue order.
+
+        Performed (or queued, for maintenance) runs are appended to
+        `done`. Runs of repos busy with maintenance are left due.
+        Returns the number of successful runs.
+        """
+        queue = self._queue_runs(due_runs, now)
+
+        # Maintenance is launched after the rest of pending runs to not
+        # compete with them.
+        pending_runs = [run for run in queue
+                        if run.action != Action.MAINTAIN]
+        maintenance_runs = [run for run in queue
+                            if run.action == Action.MAINTAIN]
+
+        # Pulls from the same remote share a single fetch, done when the
+        # first of them is dequeued.
+        pull_groups = self._group_pulls(
+            [run for run in pending_runs if run.action == Action.PULL])
+
+        success_runs = 0
+        for run in pending_runs:
+            if not self._running:
+                break
+
+            # Never wait for a repo under maintenance. The run stays due
+            # and it's tried again in the next tick.
+            repo_name = self._repos.get_name(run.repo_id)
+            lock = self._get_repo_lock(repo_name,
+                                       self._repos.get_path(run.repo_id))
+            if not lock.acquire(blocking=False):
+                logging.debug(f"Postponing '{run.action.value}' for"
+                              f" '{repo_name}' (repo is busy)")
+                continue
+
+            try:
+                self._check_latency(run)
+                if run.action == Action.PULL:
+                    success = self._perform_pull(run,
+                                                 pull_groups.get(run, None))
+                else:
+                    success = self._perform_run(run)
+            finally:
+                lock.release()
+            self._mark_done(run, success, done)
+            success_runs += success
+
+        for run in maintenance_runs:
+            if not self._running:
+                break
+            self._start_maintenance(run)
+            done.append(run)
+
+        return success_runs
+
+    def _terminate_processes(self) -> None:
+        with self._processes_guard:
+            processes = tuple(self._processes)
+
+        if processes:
+            logging.warning(f'Drain timeout reached. Terminating'
+                            f' {len(processes)} running commands...')
+
+        for process in processes:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except Exception as ex:
+                logging.debug(str(ex))
+
     def start(self) -> None:
         self._running = True
+        for worker in self._maintenance_workers:
+            worker.start()
         super().start()
 
     def run(self) -> None:
+        if self.profiler:
+            self.profiler.start()
+
         dotfile = load_dotfile(self.dotfile_path)
         next_reload = datetime.min
-        next_runs: Optional[List[RunInfo]] = None
+        next_runs: List[RunInfo] = []
+
+        # On startup, resume the schedule saved by the last run
+        known: Optional[Dict[RunKey, RunTimes]] = \
+            load_state(self.state_path)
 
         while self._running:
 
@@ -112,44 +766,104 @@ class SchedulerThread(Thread):
             #   of all files and watch for changes during runtime.
 
             #  Reload metadata if needed
-            if next_reload < datetime.now():
+            if self._reload_requested or next_reload < datetime.now():
                 logging.debug('Reloading metadata...')
-                dotfile = load_dotfile(self.dotfile_path)
+                self._reload_requested = False
+                with span('load-dotfile'):
+                    dotfile = load_dotfile(self.dotfile_path)
                 next_reload = datetime.now() + \
                     timedelta(seconds=self.reload_delay)
-                next_runs = None
-                logging.debug(f'  - Next reload on {next_reload}')
 
-            if not next_runs:
-                next_runs = self._schedule_next(dotfile, datetime.now())
+                if known is None:
+                    known = self._get_run_times(next_runs)
+                with span('schedule'):
+                    next_runs = self._schedule_next(dotfile, datetime.now(),
+                                                    known)
+                known = None
+                logging.debug(f'  - Next reload on {next_reload}')
 
             now = datetime.now()
 
             # Run all pending operations
-            pending_count = 0
-            success_runs = 0
-            for run in next_runs:
-                if run.datetime > now:
-                    continue
+            due_runs = [run for run in next_runs if run.datetime <= now]
+
+            # Runs not performed because we're stopping (or because their
+            # repo is busy) stay due, so they are saved as pending and run
+            # on the next start (or tick).
+            done: List[RunInfo] = []
+            success_runs = self._dispatch(due_runs, now, done)
 
-                pending_count += 1
-                if self._perform_run(run):
-                    success_runs += 1
+            if done:
+                pending_count = sum(1 for run in done
+                                    if run.action != Action.MAINTAIN)
+                maintenance_count = len(done) - pending_count
+                postponed_count = len(due_runs) - len(done)
 
-            if pending_count:
                 logging.info(f'Executed {pending_count} pending runs.')
                 if success_runs != pending_count:
                     logging.warning(
                         f'  - {pending_count - success_runs} errors.')
+                if maintenance_count:
+                    logging.info(
+                        f'  - {maintenance_count} maintenance runs'
+                        ' queued in background.')
+                if postponed_count:
+                    logging.info(f'  - {postponed_count} runs postponed'
+                                 ' (repo is busy).')
 
                 #  Schedule next runs.
                 #
-                # Schedule since the cached `now` instead of `datetime.now()`
-                # to not leave any time gap without a check
-                next_runs = self._schedule_next(dotfile, now)
+                # Only the executed runs need a new time. Schedule since the
+                # cached `now` instead of `datetime.now()` to not leave any
+                # time gap without a check
+                with span('reschedule'):
+                    self._reschedule(done, now)
+
+            if self.profiler:
+                self.profiler.tick()
 
             # Sleep for 1 second (we want to be responsive when closing)
             time.sleep(1)
 
+        self._drain(next_runs, known)
+
+    def _drain(self, next_runs: List[RunInfo],
+               known: Optional[Dict[RunKey, RunTimes]]) -> None:
+        # Workers skip the queued runs and stop after the running ones
+        for _ in self._maintenance_workers:
+            self._maintenance_queue.put(None)
+        for worker in self._maintenance_workers:
+            worker.join()
+
+        if self._drain_timer:
+            self._drain_timer.cancel()
+
+        if self.profiler:
+            self.profiler.stop()
+
+        # If stopped before the first schedule, the loaded state was
+        # never used and `next_runs` is still empty. Keep that state.
+        if known is None:
+            known = self._get_run_times(next_runs)
+        save_state(self.state_path, known)
+        logging.info('Scheduler stopped.')
+
+    def reload(self) -> None:
+        """Forces a config reload in the next loop iteration.
+        """
+        self._reload_requested = True
+
     def stop(self) -> None:
+        """Stops scheduling new runs.
+
+        The thread ends when the running ones finish. Commands still
+        running after `drain_timeout` seconds are terminated.
+        """
+        if not self._running:
+            return
+
         self._running = False
+        self._drain_timer = Timer(self.drain_timeout,
+                                  self._terminate_processes)
+        self._drain_timer.daemon = True
+        self._drain_timer.start()
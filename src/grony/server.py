@@ -1,16 +1,19 @@
 import re
 import cgi
+import hmac
 import json
 import logging
 import urllib.parse
 
 from functools import partial
-from threading import Thread
+from threading import RLock, Thread
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.error import HTTPError
 
-from grony.dotfile import Dotfile, load_dotfile
+from grony.dotfile import load_dotfile
 from grony.commands import CallableCommand, Commands
+from grony.profiling import stats
+from grony.runtime import get_runtime_path, remove_runtime, save_runtime
 
 from typing import Any, Dict, List, Optional
 
@@ -18,21 +21,59 @@ from typing import Any, Dict, List, Optional
 class ServerThread(Thread):
     def __init__(self, dotfile_path: str) -> None:
         super().__init__()
-        dotfile = load_dotfile(dotfile_path)
-        port = dotfile.getint('config', 'ipc_port')
-        endpoint = ('127.0.0.1', port)
-        self.server = HTTPServer(endpoint, partial(Handler, dotfile))
+        self.dotfile_path = dotfile_path
+        self.dotfile = load_dotfile(dotfile_path)
+        self.runtime_path = get_runtime_path(dotfile_path)
+        self._load_secret()
+
+        # Guards `dotfile` (and the cached secret) between the request
+        # handlers and reloads. Reentrant, as reloads run from signal
+        # handlers.
+        self.lock = RLock()
+
+        port = self.dotfile.getint('config', 'ipc_port')
+        self.endpoint = ('127.0.0.1', port)
+        self.server = HTTPServer(self.endpoint, partial(Handler, self))
+
+    def _load_secret(self) -> None:
+        # Cached, so requests don't need to touch the config
+        self.secret = self.dotfile.get('config', 'secret')
+        self.auth_header = f'Bearer {self.secret}'.encode()
+
+    def _publish_runtime(self) -> None:
+        host, port = self.endpoint
+        save_runtime(self.runtime_path, host, port, self.secret)
 
     def run(self):
+        self._publish_runtime()
         self.server.serve_forever()
 
+    def reload(self):
+        # A new dotfile is swapped in, so a command running with the
+        # current one never sees it half loaded.
+        with self.lock:
+            try:
+                dotfile = load_dotfile(self.dotfile_path, with_defaults=False)
+                secret = dotfile.get('config', 'secret')
+            except Exception as ex:
+                logging.error(f"Can't reload {self.dotfile_path}: {ex}."
+                              ' Keeping the current config.')
+                return
+
+            self.dotfile = dotfile
+            self.secret = secret
+            self.auth_header = f'Bearer {secret}'.encode()
+
+        self._publish_runtime()
+
     def stop(self):
         self.server.shutdown()
+        remove_runtime(self.runtime_path)
 
 
 class Handler(BaseHTTPRequestHandler):
-    def __init__(self, dotfile: Dotfile, *args, **kwargs) -> None:
-        self.dotfile = dotfile
+    def __init__(self, owner: ServerThread, *args, **kwargs) -> None:
+        self.owner = owner
         super().__init__(*args, *kwargs)
 
     def send(self, data: Any, response_code: int = 200):
@@ -57,22 +98,20 @@ class Handler(BaseHTTPRequestHandler):
         self.send('Go home', 500)
         return
 
-    def get_command(self) -> Optional[CallableCommand]:
-        secret = self.dotfile.get('config', 'secret')
-
+    def is_authorized(self) -> bool:
         if self.client_address[0] != '127.0.0.1':
             self.reject_request(
                 f'Invalid request (address = {self.client_address})')
-            return None
+            return False
 
-        auth_headers = (k for k, v in self.headers.items()
-                        if k == "Authorization"
-                        and v == f"Bearer {secret}")
-        auth = next(auth_headers, None)
-        if not auth:
+        auth = self.headers.get('Authorization', '').encode()
+        if not hmac.compare_digest(auth, self.owner.auth_header):
             self.reject_request('Invalid request (authentication failed)')
-            return None
+            return False
 
+        return True
+
+    def get_command(self) -> Optional[CallableCommand]:
         m = re.match(r'^\/grony\/([^\/]+)/?', self.path)
         if not m:
             self.reject_request('Invalid request')
@@ -82,6 +121,13 @@ class Handler(BaseHTTPRequestHandler):
         return Commands.get_command(command)
 
     def do_POST(self) -> None:
+        if not self.is_authorized():
+            return
+
+        if re.match(r'^\/grony\/debug\/stats\/?$', self.path):
+            self.send(stats.snapshot())
+            return
+
         fn = self.get_command()
         if not fn:
             self.reject_request("Unrecognized command")
@@ -94,7 +140,8 @@ class Handler(BaseHTTPRequestHandler):
             # we only have a value for each key
             args = dict((k, v[0]) for k, v in self._get_data().items())
 
-            success, msg = fn(self.dotfile, args)
+            with self.owner.lock:
+                success, msg = fn(self.owner.dotfile, args)
             severity = 'success' if success else 'error'
             messages.append({'severity': severity, 'message': msg})
         except HTTPError as ex:
@@ -0,0 +1,36 @@
+import os
+import stat
+import subprocess
+
+from pathlib import Path
+
+from grony.runtime import get_runtime_path, load_runtime, save_runtime
+
+
+def test_runtime_round_trip(tmp_path: Path) -> None:
+    path = get_runtime_path(str(tmp_path / 'grony.conf'))
+    save_runtime(path, '127.0.0.1', 62830, 'secret')
+
+    assert load_runtime(path) == {'host': '127.0.0.1', 'port': 62830,
+                                  'secret': 'secret', 'pid': os.getpid()}
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_runtime_is_private_with_existing_temp_file(tmp_path: Path) -> None:
+    path = get_runtime_path(str(tmp_path / 'grony.conf'))
+    Path(f'{path}.tmp').touch(mode=0o644)
+
+    save_runtime(path, '127.0.0.1', 62830, 'secret')
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_runtime_of_dead_server_is_ignored(tmp_path: Path) -> None:
+    path = get_runtime_path(str(tmp_path / 'grony.conf'))
+    process = subprocess.Popen(['true'])
+    process.wait()
+    Path(path).write_text('{"host": "127.0.0.1", "port": 62830,'
+                          f' "secret": "secret", "pid": {process.pid}}}')
+
+    assert load_runtime(path) is None
+    assert load_runtime(str(tmp_path / 'missing')) is None
@@ -0,0 +1,296 @@
+import subprocess
+
+from functools import partial
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+from grony.dotfile import load_dotfile
+from grony.scheduler import (LOCAL_PULL_COMMAND, Action, RunInfo,
+                             SchedulerThread, load_state, save_state)
+
+from typing import List, Optional, Tuple
+
+
+def git(cwd: Path, *args: str) -> str:
+    result = subprocess.run(('git',) + args, cwd=cwd, check=True,
+                            capture_output=True, text=True)
+    return result.stdout.strip()
+
+
+def commit(repo: Path, message: str) -> str:
+    git(repo, 'commit', '-q', '--allow-empty', '-m', message)
+    return git(repo, 'rev-parse', 'HEAD')
+
+
+@pytest.fixture
+def fleet(tmp_path: Path, monkeypatch) -> Path:
+    """A bare remote with two clones (`a` and `b`) and a worktree of `a`
+    (`a-wt`) all scheduled to pull.
+    """
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('GIT_CONFIG_NOSYSTEM', '1')
+    for key in ('GIT_AUTHOR', 'GIT_COMMITTER'):
+        monkeypatch.setenv(f'{key}_NAME', 'grony')
+        monkeypatch.setenv(f'{key}_EMAIL', 'grony@localhost')
+
+    git(tmp_path, 'init', '-q', '--bare', '-b', 'main', 'origin.git')
+    git(tmp_path, 'clone', '-q', 'origin.git', 'seed')
+    seed = tmp_path / 'seed'
+    commit(seed, 'initial')
+    git(seed, 'branch', 'other')
+    git(seed, 'push', '-q', 'origin', 'main', 'other')
+
+    git(tmp_path, 'clone', '-q', 'origin.git', 'a')
+    git(tmp_path, 'clone', '-q', 'origin.git', 'b')
+    git(tmp_path / 'a', 'worktree', 'add', '-q', '../a-wt',
+        '-b', 'other', '--track', 'origin/other')
+
+    conf = ['[config]', 'ipc_port = 62830', 'secret = test']
+    for name in ('a', 'a-wt', 'b'):
+        conf += [f"[repo '{name}']",
+                 f'path = {tmp_path / name}',
+                 'pull-on = @hourly']
+    (tmp_path / 'grony.conf').write_text('\n'.join(conf) + '\n')
+
+    return tmp_path
+
+
+def publish(fleet: Path, branch: str, message: str) -> str:
+    seed = fleet / 'seed'
+    git(seed, 'checkout', '-q', branch)
+    sha = commit(seed, message)
+    git(seed, 'push', '-q', 'origin', branch)
+    return sha
+
+
+def run_pulls(fleet: Path, paths: Optional[List[str]] = None,
+              scheduler: Optional[SchedulerThread] = None
+              ) -> Tuple[List[str], int]:
+    """Dispatches the pulls of all repos at once.
+
+    Returns the commands run and the number of successful runs. The path
+    of each command is appended to `paths`, if given.
+    """
+    if not scheduler:
+        scheduler = SchedulerThread(str(fleet / 'grony.conf'), 5)
+    scheduler._running = True
+
+    commands: List[str] = []
+    run_command = partial(SchedulerThread._run_command, scheduler)
+
+    def record(command: str, path: str, quiet: bool = False) -> bool:
+        commands.append(command)
+        if paths is not None:
+            paths.append(path)
+        return run_command(command, path, quiet)
+
+    scheduler._run_command = record  # type: ignore
+
+    now = datetime.now()
+    runs = scheduler._schedule_next(load_dotfile(str(fleet / 'grony.conf')),
+                                    now)
+    success_runs = scheduler._dispatch(runs, now, [])
+    return commands, success_runs
+
+
+def network_commands(commands: List[str]) -> List[str]:
+    return [c for c in commands
+            if c.startswith('git fetch origin')
+            or (c.startswith('git pull') and c != LOCAL_PULL_COMMAND)]
+
+
+def test_shared_pull_fetches_remote_once(fleet: Path) -> None:
+    main = publish(fleet, 'main', 'main update')
+    other = publish(fleet, 'other', 'other update')
+
+    commands, success_runs = run_pulls(fleet)
+
+    assert success_runs == 3
+    assert network_commands(commands) == ['git fetch origin']
+    assert git(fleet / 'a', 'rev-parse', 'HEAD') == main
+    assert git(fleet / 'b', 'rev-parse', 'HEAD') == main
+    assert git(fleet / 'a-wt', 'rev-parse', 'HEAD') == other
+
+
+def test_shared_pull_merges_diverged_checkout_locally(fleet: Path) -> None:
+    local = commit(fleet / 'b', 'unpushed auto commit')
+    git(fleet / 'b', 'config', 'pull.rebase', 'false')
+    main = publish(fleet, 'main', 'main update')
+
+    commands, success_runs = run_pulls(fleet)
+
+    assert success_runs == 3
+    assert network_commands(commands) == ['git fetch origin']
+    parents = git(fleet / 'b', 'rev-parse', 'HEAD^1', 'HEAD^2').split()
+    assert parents == [local, main]
+
+
+def test_shared_pull_rebases_diverged_checkout_locally(fleet: Path) -> None:
+    commit(fleet / 'b', 'unpushed auto commit')
+    git(fleet / 'b', 'config', 'pull.rebase', 'true')
+    main = publish(fleet, 'main', 'main update')
+
+    commands, success_runs = run_pulls(fleet)
+
+    assert success_runs == 3
+    assert network_commands(commands) == ['git fetch origin']
+    assert git(fleet / 'b', 'rev-parse', 'HEAD~1') == main
+    assert git(fleet / 'b', 'log', '-1', '--format=%s') \
+        == 'unpushed auto commit'
+
+
+def test_shared_pull_keeps_priority_order(fleet: Path) -> None:
+    git(fleet, 'init', '-q', 'local')
+    (fleet / 'local' / 'notes.txt').write_text('pending changes\n')
+    conf = fleet / 'grony.conf'
+    conf.write_text(conf.read_text()
+                    .replace("[repo 'b']", "[repo 'b']\npriority = 10")
+                    + "[repo 'local']\n"
+                    + f"path = {fleet / 'local'}\n"
+                    + 'commit-on = @hourly\n'
+                    + 'priority = 5\n')
+    main = publish(fleet, 'main', 'main update')
+
+    paths: List[str] = []
+    commands, success_runs = run_pulls(fleet, paths)
+
+    assert success_runs == 4
+    assert network_commands(commands) == ['git fetch origin']
+    # The higher priority repo does the shared fetch, but the rest of
+    # the group waits for the commit of the repo with priority 5.
+    order = [Path(path).name for path in paths]
+    assert order[0] == 'b'
+    assert order.index('local') < order.index('a')
+    assert order.index('local') < order.index('a-wt')
+    assert git(fleet / 'a', 'rev-parse', 'HEAD') == main
+
+
+def test_shared_pull_follows_remote_url_changes(fleet: Path) -> None:
+    scheduler = SchedulerThread(str(fleet / 'grony.conf'), 5)
+    run_pulls(fleet, scheduler=scheduler)
+
+    git(fleet, 'clone', '-q', '--bare', 'origin.git', 'fork.git')
+    git(fleet / 'b', 'remote', 'set-url', 'origin', str(fleet / 'fork.git'))
+    fork = git(fleet / 'fork.git', 'rev-parse', 'main')
+    publish(fleet, 'main', 'main update')
+
+    commands, success_runs = run_pulls(fleet, scheduler=scheduler)
+
+    # `b` doesn't share the fetch anymore, so it doesn't get the update
+    # published to its old remote
+    assert success_runs == 3
+    assert network_commands(commands) == ['git fetch origin', 'git pull ']
+    assert git(fleet / 'b', 'rev-parse', 'HEAD') == fork
+
+
+def test_shared_pull_uses_branch_upstream_remote(fleet: Path) -> None:
+    # `b` tracks `upstream`, while its `origin` is the remote of the rest
+    git(fleet, 'clone', '-q', '--bare', 'origin.git', 'upstream.git')
+    b = fleet / 'b'
+    git(b, 'remote', 'add', 'upstream', str(fleet / 'upstream.git'))
+    git(b, 'fetch', '-q', 'upstream')
+    git(b, 'branch', '-q', '-u', 'upstream/main')
+
+    seed = fleet / 'seed'
+    git(seed, 'checkout', '-q', 'main')
+    upstream = commit(seed, 'upstream update')
+    git(seed, 'push', '-q', str(fleet / 'upstream.git'), 'main')
+
+    commands, success_runs = run_pulls(fleet)
+
+    assert success_runs == 3
+    assert network_commands(commands) == ['git fetch origin', 'git pull ']
+    assert git(b, 'rev-parse', 'HEAD') == upstream
+
+
+def test_busy_repo_runs_stay_due(fleet: Path) -> None:
+    scheduler = SchedulerThread(str(fleet / 'grony.conf'), 5)
+    scheduler._running = True
+
+    now = datetime.now()
+    runs = scheduler._schedule_next(load_dotfile(str(fleet / 'grony.conf')),
+                                    now)
+
+    # A maintenance run in `a` also locks its worktree, `a-wt`
+    lock = scheduler._get_repo_lock('a', str(fleet / 'a'))
+    lock.acquire()
+    try:
+        done: List[RunInfo] = []
+        success_runs = scheduler._dispatch(runs, now, done)
+    finally:
+        lock.release()
+
+    assert success_runs == 1
+    assert [scheduler._repos.get_name(run.repo_id) for run in done] == ['b']
+
+
+def test_state_round_trip(tmp_path: Path) -> None:
+    path = str(tmp_path / 'grony.state')
+    next_run = datetime(2026, 1, 1, 10, 0)
+    runs = {('a', Action.PULL, '@hourly'): (next_run, None),
+            ('a', Action.COMMIT, '*/5 * * * *'):
+                (next_run, next_run - timedelta(minutes=5))}
+
+    save_state(path, runs)
+
+    assert load_state(path) == runs
+
+
+def test_state_ignores_missing_or_invalid_files(tmp_path: Path) -> None:
+    path = tmp_path / 'grony.state'
+    assert load_state(str(path)) == {}
+
+    path.write_text('{"runs": [')
+    assert load_state(str(path)) == {}
+
+
+def make_stopping_repo(tmp_path: Path, next_run: datetime) -> SchedulerThread:
+    """A scheduler with a single commit in `repo` due at `next_run`.
+    """
+    (tmp_path / 'repo').mkdir()
+    (tmp_path / 'grony.conf').write_text(
+        '[config]\nipc_port = 62830\nsecret = test\n'
+        f"[repo 'repo']\npath = {tmp_path / 'repo'}\n"
+        'commit-on = * * * * *\n')
+
+    scheduler = SchedulerThread(str(tmp_path / 'grony.conf'), 5,
+                                drain_timeout_seconds=1)
+    save_state(scheduler.state_path,
+               {('repo', Action.COMMIT, '* * * * *'): (next_run, None)})
+    return scheduler
+
+
+def test_stop_before_first_schedule_keeps_state(tmp_path: Path) -> None:
+    next_run = datetime.now() + timedelta(hours=1)
+    scheduler = make_stopping_repo(tmp_path, next_run)
+    saved = load_state(scheduler.state_path)
+
+    # Stopped before the loop's first pass
+    for worker in scheduler._maintenance_workers:
+        worker.start()
+    scheduler.run()
+
+    assert load_state(scheduler.state_path) == saved
+
+
+def test_drain_keeps_terminated_runs_due(tmp_path: Path) -> None:
+    next_run = datetime.now().replace(second=0, microsecond=0) \
+        - timedelta(minutes=1)
+    scheduler = make_stopping_repo(tmp_path, next_run)
+
+    run_command = partial(SchedulerThread._run_command, scheduler)
+
+    def stop_and_hang(command: str, path: str, quiet: bool = False) -> bool:
+        scheduler.stop()
+        return run_command('sleep 30', path, quiet)
+
+    scheduler._run_command = stop_and_hang  # type: ignore
+    scheduler.start()
+    scheduler.join(timeout=15)
+
+    # Killed at the drain timeout, so it's still due
+    assert not scheduler.is_alive()
+    assert load_state(scheduler.state_path) == \
+        {('repo', Action.COMMIT, '* * * * *'): (next_run, None)}
@@ -0,0 +1,73 @@
+import os
+import time
+import socket
+
+from pathlib import Path
+
+import pytest
+
+from grony.client import Client
+from grony.runtime import get_runtime_path, save_runtime
+from grony.server import ServerThread
+
+from typing import Iterator
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server(tmp_path: Path) -> Iterator[ServerThread]:
+    path = tmp_path / 'grony.conf'
+    path.write_text(f'[config]\nipc_port = {get_free_port()}\n'
+                    'secret = right\n')
+
+    Client._cache.clear()
+    thread = ServerThread(str(path))
+    thread.start()
+
+    # Wait for the runtime descriptor
+    for _ in range(100):
+        if os.path.exists(thread.runtime_path):
+            break
+        time.sleep(0.05)
+
+    try:
+        yield thread
+    finally:
+        thread.stop()
+        thread.join()
+        thread.server.server_close()
+        Client._cache.clear()
+
+
+def test_server_requires_secret(server: ServerThread) -> None:
+    host, port = server.endpoint
+
+    result = Client(host, port, 'wrong').make_request('debug/stats')
+    assert result == 'Go home'
+
+    result = Client(host, port, 'right').make_request('debug/stats')
+    assert 'phases' in result
+
+
+def test_client_uses_runtime_descriptor(server: ServerThread) -> None:
+    client = Client.connect(server.dotfile_path)
+
+    assert client.dotfile_path == server.dotfile_path
+    assert 'phases' in client.make_request('debug/stats')
+
+
+def test_client_falls_back_to_dotfile(server: ServerThread) -> None:
+    # A descriptor of a dead server whose pid is in use by this process
+    save_runtime(get_runtime_path(server.dotfile_path), '127.0.0.1',
+                 get_free_port(), 'stale')
+
+    client = Client.connect(server.dotfile_path)
+    assert client.secret == 'stale'
+
+    assert 'phases' in client.make_request('debug/stats')
+    assert (client.port, client.secret) == (server.endpoint[1], 'right')